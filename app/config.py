@@ -14,6 +14,15 @@ class Settings(BaseSettings):
     domain: str = "cebralab.com"
 
     beca_object_id: str = "2-43416319"
+    # Tipo de asociación contacto -> beca
+    contact_beca_association_type_id: int = 409
+
+    # Ventana (ms) para agrupar actualizaciones sobre el mismo objeto; 0 la desactiva
+    hubspot_coalesce_window_ms: int = 0
+    # Llamadas simultáneas a HubSpot y turnos mínimos garantizados al tráfico de fondo
+    # (entre 0 y 0.5; con 0.5 se alternan ambas prioridades)
+    hubspot_max_concurrent_requests: int = 4
+    hubspot_background_share: float = 0.2
 
     class Config:
         env_file = ".env"
@@ -14,7 +14,12 @@ app = FastAPI(
 api_router = APIRouter(prefix="/api/v1")
 
 # Inicializar servicio de HubSpot
-hubspot_service = HubspotService(api_key=settings.hubspot_api_key)
+hubspot_service = HubspotService(
+    api_key=settings.hubspot_api_key,
+    coalesce_window_ms=settings.hubspot_coalesce_window_ms,
+    max_concurrent_requests=settings.hubspot_max_concurrent_requests,
+    background_share=settings.hubspot_background_share,
+)
 
 
 @api_router.get("/health")
@@ -22,6 +27,11 @@ async def health_check():
     return {"status": "healthy", "version": app.version}
 
 
+@api_router.get("/hubspot/queues")
+async def hubspot_queues():
+    return hubspot_service.scheduler.stats()
+
+
 @api_router.get("/sdk/fech-request")
 async def hubspot_webhook():
     return {
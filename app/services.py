@@ -1,4 +1,20 @@
-from typing import Any, Dict, Optional, Tuple
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+)
 from uuid import uuid4
 
 import httpx
@@ -7,9 +23,134 @@ from fastapi import HTTPException
 from app.config import settings
 from app.models import DatosRegistro
 
+Priority = Literal["interactive", "background"]
+
+
+class HubspotScheduler:
+    """
+    Reparte la cuota de HubSpot entre el tráfico interactivo y el de fondo.
+
+    El tráfico interactivo siempre se atiende primero, pero mientras haya
+    llamadas de fondo en cola éstas reciben al menos `background_share` de
+    los turnos, de modo que los procesos masivos no queden bloqueados.
+    """
+
+    def __init__(self, max_concurrent: int, background_share: float):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent debe ser al menos 1")
+        # Sobre 0.5 el tráfico de fondo pasaría antes que el interactivo
+        if not 0 < background_share <= 0.5:
+            raise ValueError("background_share debe estar en el rango (0, 0.5]")
+
+        self._slots = max_concurrent
+        # Turnos interactivos consecutivos permitidos con tráfico de fondo en cola;
+        # se redondea hacia abajo para no quedar bajo la cuota configurada
+        self._max_interactive_streak = math.floor(1 / background_share) - 1
+        self._interactive_streak = 0
+        self._queues: Dict[str, Deque[asyncio.Future]] = {
+            "interactive": deque(),
+            "background": deque(),
+        }
+        self._stats: Dict[str, Dict[str, float]] = {
+            lane: {"served": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for lane in self._queues
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority) -> AsyncIterator[None]:
+        """
+        Reserva un turno para una llamada a HubSpot según su prioridad.
+
+        Args:
+            priority (Priority): Clase de prioridad de la llamada
+
+        Raises:
+            ValueError: Si la prioridad no es una clase conocida
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Prioridad desconocida: {priority}")
+
+        inicio = time.monotonic()
+
+        if self._slots > 0:
+            self._slots -= 1
+        else:
+            turno = asyncio.get_running_loop().create_future()
+            self._queues[priority].append(turno)
+            try:
+                await turno
+            except asyncio.CancelledError:
+                if turno.cancelled():
+                    self._queues[priority].remove(turno)
+                else:
+                    # El turno ya fue asignado; cederlo al siguiente en cola
+                    self._release()
+                raise
+
+        self._record_wait(priority, time.monotonic() - inicio)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        """
+        Cede el turno liberado al siguiente en cola o lo devuelve al pool.
+        """
+        interactivas = self._queues["interactive"]
+        fondo = self._queues["background"]
+
+        if fondo and (
+            not interactivas or self._interactive_streak >= self._max_interactive_streak
+        ):
+            self._interactive_streak = 0
+            fondo.popleft().set_result(None)
+        elif interactivas:
+            self._interactive_streak = self._interactive_streak + 1 if fondo else 0
+            interactivas.popleft().set_result(None)
+        else:
+            self._slots += 1
+
+    def _record_wait(self, priority: Priority, wait: float) -> None:
+        stats = self._stats[priority]
+        stats["served"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Devuelve los tiempos de espera en cola de cada prioridad.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Métricas por prioridad (en cola, atendidas,
+            espera promedio y máxima en milisegundos)
+        """
+        return {
+            lane: {
+                "queued": len(self._queues[lane]),
+                "served": int(stats["served"]),
+                "avg_wait_ms": round(
+                    (
+                        stats["total_wait"] / stats["served"] * 1000
+                        if stats["served"]
+                        else 0.0
+                    ),
+                    2,
+                ),
+                "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+            }
+            for lane, stats in self._stats.items()
+        }
+
 
 class HubspotService:
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        coalesce_window_ms: int = 0,
+        max_concurrent_requests: int = 4,
+        background_share: float = 0.2,
+    ):
         self.api_key = api_key
         self.base_url = "https://api.hubapi.com"
         self.headers = {
@@ -17,12 +158,131 @@ class HubspotService:
             "content-type": "application/json",
         }
 
-    async def search_contact_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        # Prioridad de las llamadas que comparten la cuota de HubSpot
+        self.scheduler = HubspotScheduler(
+            max_concurrent=max_concurrent_requests,
+            background_share=background_share,
+        )
+
+        # Agrupación de actualizaciones sucesivas sobre el mismo objeto
+        self.coalesce_window = coalesce_window_ms / 1000
+        self._pending_updates: Dict[str, Dict[str, Any]] = {}
+        self._update_locks: Dict[str, asyncio.Lock] = {}
+        self._flush_tasks: Set[asyncio.Task] = set()
+
+    @asynccontextmanager
+    async def _client(self, priority: Priority) -> AsyncIterator[httpx.AsyncClient]:
+        """
+        Abre un cliente HTTP una vez que el scheduler asigna turno a la llamada.
+
+        Args:
+            priority (Priority): Clase de prioridad de la llamada
+        """
+        async with self.scheduler.slot(priority):
+            async with httpx.AsyncClient() as client:
+                yield client
+
+    async def _coalesce_update(
+        self,
+        key: str,
+        properties: Dict[str, Any],
+        priority: Priority,
+        send: Callable[[Dict[str, Any], Priority], Awaitable[Dict[str, Any]]],
+    ) -> Dict[str, Any]:
+        """
+        Agrupa las actualizaciones pendientes sobre un mismo objeto en un único PATCH.
+
+        Las propiedades recibidas dentro de la ventana se combinan de modo que la
+        última escritura prevalece, y todos los llamadores reciben el resultado final.
+        Los lotes de un mismo objeto se envían de a uno y en orden de llegada.
+
+        Args:
+            key (str): Identificador del objeto (URL del recurso)
+            properties (Dict[str, Any]): Propiedades a actualizar
+            priority (Priority): Clase de prioridad de la llamada
+            send (Callable): Función que envía el PATCH con las propiedades combinadas
+
+        Returns:
+            Dict[str, Any]: Los datos actualizados del objeto
+        """
+        if self.coalesce_window <= 0:
+            return await send(properties, priority)
+
+        pending = self._pending_updates.get(key)
+        if pending is None:
+            pending = {
+                "properties": {},
+                "priority": priority,
+                "future": asyncio.get_running_loop().create_future(),
+            }
+            self._pending_updates[key] = pending
+            task = asyncio.create_task(self._flush_update(key, pending, send))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+
+        pending["properties"].update(properties)
+
+        # El lote hereda la prioridad interactiva si algún llamador la tiene
+        if priority == "interactive":
+            pending["priority"] = priority
+
+        # shield evita que la cancelación de un llamador cancele el lote compartido
+        return await asyncio.shield(pending["future"])
+
+    async def _flush_update(
+        self,
+        key: str,
+        pending: Dict[str, Any],
+        send: Callable[[Dict[str, Any], Priority], Awaitable[Dict[str, Any]]],
+    ) -> None:
+        """
+        Envía un lote de actualizaciones una vez cerrada su ventana.
+
+        Args:
+            key (str): Identificador del objeto (URL del recurso)
+            pending (Dict[str, Any]): Lote con las propiedades combinadas y su future
+            send (Callable): Función que envía el PATCH con las propiedades combinadas
+        """
+        future = pending["future"]
+        # Marcar la excepción como leída aunque todos los llamadores se cancelen
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        try:
+            await asyncio.sleep(self.coalesce_window)
+
+            lock = self._update_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                # El lote sigue aceptando cambios mientras espera al PATCH anterior
+                if self._pending_updates.get(key) is pending:
+                    del self._pending_updates[key]
+
+                try:
+                    result = await send(pending["properties"], pending["priority"])
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            # Si la tarea se cancela, cerrar el lote y liberar a los llamadores
+            if self._pending_updates.get(key) is pending:
+                del self._pending_updates[key]
+            if not future.done():
+                future.cancel()
+
+            # Sin lotes pendientes ni PATCH en curso nadie más espera este lock
+            lock = self._update_locks.get(key)
+            if key not in self._pending_updates and lock and not lock.locked():
+                del self._update_locks[key]
+
+    async def search_contact_by_email(
+        self, email: str, priority: Priority = "interactive"
+    ) -> Optional[Dict[str, Any]]:
         """
         Busca un contacto en HubSpot por su dirección de correo electrónico.
 
         Args:
             email (str): El correo electrónico a buscar
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Optional[Dict[str, Any]]: Los datos del contacto si se encuentra, None si no existe
@@ -49,7 +309,7 @@ class HubspotService:
         }
 
         try:
-            async with httpx.AsyncClient() as client:
+            async with self._client(priority) as client:
                 response = await client.post(url, headers=self.headers, json=payload)
 
                 # Verificar si la respuesta es exitosa
@@ -83,6 +343,8 @@ class HubspotService:
         lastname: str,
         rut: Optional[str] = None,
         pasaporte: Optional[str] = None,
+        beca_id: Optional[str] = None,
+        priority: Priority = "interactive",
     ) -> Dict[str, Any]:
         """
         Crea un nuevo contacto en HubSpot.
@@ -93,6 +355,8 @@ class HubspotService:
             lastname (str): Apellido del contacto
             rut (Optional[str]): RUT del contacto, si aplica
             pasaporte (Optional[str]): Número de pasaporte, si aplica
+            beca_id (Optional[str]): ID de una beca a asociar en la misma creación
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Dict[str, Any]: Los datos del contacto creado
@@ -117,8 +381,22 @@ class HubspotService:
 
         payload = {"properties": properties}
 
+        # Asociar la beca en la misma llamada, evitando un PUT adicional
+        if beca_id:
+            payload["associations"] = [
+                {
+                    "to": {"id": beca_id},
+                    "types": [
+                        {
+                            "associationCategory": "USER_DEFINED",
+                            "associationTypeId": settings.contact_beca_association_type_id,
+                        }
+                    ],
+                }
+            ]
+
         try:
-            async with httpx.AsyncClient() as client:
+            async with self._client(priority) as client:
                 response = await client.post(url, headers=self.headers, json=payload)
 
                 # Verificar si la respuesta es exitosa
@@ -148,6 +426,7 @@ class HubspotService:
         lastname: Optional[str] = None,
         rut: Optional[str] = None,
         pasaporte: Optional[str] = None,
+        priority: Priority = "interactive",
     ) -> Dict[str, Any]:
         """
         Actualiza un contacto existente en HubSpot.
@@ -159,6 +438,7 @@ class HubspotService:
             lastname (Optional[str]): Nuevo apellido
             rut (Optional[str]): Nuevo RUT
             pasaporte (Optional[str]): Nuevo número de pasaporte
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Dict[str, Any]: Los datos actualizados del contacto
@@ -188,38 +468,48 @@ class HubspotService:
                 detail="No se proporcionaron datos para actualizar",
             )
 
-        payload = {"properties": properties}
+        async def enviar(
+            properties: Dict[str, Any], priority: Priority
+        ) -> Dict[str, Any]:
+            payload = {"properties": properties}
 
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.patch(url, headers=self.headers, json=payload)
+            try:
+                async with self._client(priority) as client:
+                    response = await client.patch(
+                        url, headers=self.headers, json=payload
+                    )
 
-                # Verificar si la respuesta es exitosa
-                response.raise_for_status()
+                    # Verificar si la respuesta es exitosa
+                    response.raise_for_status()
 
-                return response.json()
+                    return response.json()
 
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=f"Contacto con ID {contact_id} no encontrado",
+                    )
                 raise HTTPException(
-                    status_code=404,
-                    detail=f"Contacto con ID {contact_id} no encontrado",
+                    status_code=e.response.status_code,
+                    detail={
+                        "message": "Error al actualizar contacto en HubSpot",
+                        "status": e.response.json(),
+                    },
+                )
+            except Exception as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Error interno del servidor al actualizar contacto: {str(e)}",
                 )
-            raise HTTPException(
-                status_code=e.response.status_code,
-                detail={
-                    "message": "Error al actualizar contacto en HubSpot",
-                    "status": e.response.json(),
-                },
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error interno del servidor al actualizar contacto: {str(e)}",
-            )
+
+        return await self._coalesce_update(url, properties, priority, enviar)
 
     async def search_beca_by_email(
-        self, email: str, carrera_consolidada: Optional[str] = None
+        self,
+        email: str,
+        carrera_consolidada: Optional[str] = None,
+        priority: Priority = "interactive",
     ) -> Optional[Dict[str, Any]]:
         """
         Busca una beca en HubSpot por el correo electrónico del postulante.
@@ -227,6 +517,7 @@ class HubspotService:
         Args:
             email (str): El correo electrónico a buscar
             carrera_consolidada (Optional[str]): La carrera consolidada a buscar
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Optional[Dict[str, Any]]: Los datos de la beca si se encuentra, None si no existe
@@ -266,7 +557,7 @@ class HubspotService:
         }
 
         try:
-            async with httpx.AsyncClient() as client:
+            async with self._client(priority) as client:
                 response = await client.post(url, headers=self.headers, json=payload)
                 response.raise_for_status()
 
@@ -299,6 +590,7 @@ class HubspotService:
         carrera_consolidada: str,
         rut: Optional[str] = None,
         pasaporte: Optional[str] = None,
+        priority: Priority = "interactive",
     ) -> Dict[str, Any]:
         """
         Crea una nueva beca en HubSpot.
@@ -310,6 +602,7 @@ class HubspotService:
             carrera_consolidada (str): Carrera consolidada
             rut (Optional[str]): RUT del postulante, si aplica
             pasaporte (Optional[str]): Número de pasaporte, si aplica
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Dict[str, Any]: Los datos de la beca creada
@@ -337,7 +630,7 @@ class HubspotService:
         payload = {"properties": properties}
 
         try:
-            async with httpx.AsyncClient() as client:
+            async with self._client(priority) as client:
                 response = await client.post(url, headers=self.headers, json=payload)
                 response.raise_for_status()
                 return response.json()
@@ -365,6 +658,7 @@ class HubspotService:
         carrera_consolidada: Optional[str] = None,
         rut: Optional[str] = None,
         pasaporte: Optional[str] = None,
+        priority: Priority = "interactive",
     ) -> Dict[str, Any]:
         """
         Actualiza una beca existente en HubSpot.
@@ -377,6 +671,7 @@ class HubspotService:
             carrera_consolidada (Optional[str]): Nueva carrera consolidada
             rut (Optional[str]): Nuevo RUT
             pasaporte (Optional[str]): Nuevo número de pasaporte
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Dict[str, Any]: Los datos actualizados de la beca
@@ -408,35 +703,42 @@ class HubspotService:
                 detail="No se proporcionaron datos para actualizar",
             )
 
-        payload = {"properties": properties}
-
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.patch(url, headers=self.headers, json=payload)
-                response.raise_for_status()
-                return response.json()
-
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
+        async def enviar(
+            properties: Dict[str, Any], priority: Priority
+        ) -> Dict[str, Any]:
+            payload = {"properties": properties}
+
+            try:
+                async with self._client(priority) as client:
+                    response = await client.patch(
+                        url, headers=self.headers, json=payload
+                    )
+                    response.raise_for_status()
+                    return response.json()
+
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=f"Beca con ID {beca_id} no encontrada",
+                    )
                 raise HTTPException(
-                    status_code=404,
-                    detail=f"Beca con ID {beca_id} no encontrada",
+                    status_code=e.response.status_code,
+                    detail={
+                        "message": "Error al actualizar beca en HubSpot",
+                        "status": e.response.json(),
+                    },
+                )
+            except Exception as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Error interno del servidor al actualizar beca: {str(e)}",
                 )
-            raise HTTPException(
-                status_code=e.response.status_code,
-                detail={
-                    "message": "Error al actualizar beca en HubSpot",
-                    "status": e.response.json(),
-                },
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error interno del servidor al actualizar beca: {str(e)}",
-            )
+
+        return await self._coalesce_update(url, properties, priority, enviar)
 
     async def associate_contact_with_beca(
-        self, contact_id: str, beca_id: str
+        self, contact_id: str, beca_id: str, priority: Priority = "interactive"
     ) -> Dict[str, Any]:
         """
         Asocia un contacto con una beca en HubSpot.
@@ -444,6 +746,7 @@ class HubspotService:
         Args:
             contact_id (str): ID del contacto en HubSpot
             beca_id (str): ID de la beca en HubSpot
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Dict[str, Any]: Respuesta de la API de HubSpot
@@ -454,13 +757,13 @@ class HubspotService:
         url = f"{self.base_url}/crm/v4/objects/0-1/{contact_id}/associations/{settings.beca_object_id}/{beca_id}"
 
         try:
-            async with httpx.AsyncClient() as client:
+            async with self._client(priority) as client:
                 response = await client.put(
                     url,
                     json=[
                         {
                             "associationCategory": "USER_DEFINED",
-                            "associationTypeId": 409,
+                            "associationTypeId": settings.contact_beca_association_type_id,
                         }
                     ],
                     headers=self.headers,
@@ -488,13 +791,14 @@ class HubspotService:
             )
 
     async def process_registro(
-        self, datos: DatosRegistro
+        self, datos: DatosRegistro, priority: Priority = "interactive"
     ) -> Tuple[Dict[str, Any], Dict[str, Any], bool, bool]:
         """
         Procesa un registro de datos, creando o actualizando el contacto y la beca, y los asocia.
 
         Args:
             datos (DatosRegistro): Datos del registro a procesar
+            priority (Priority): Clase de prioridad de la llamada a HubSpot
 
         Returns:
             Tuple[Dict[str, Any], Dict[str, Any], bool, bool]:
@@ -511,7 +815,9 @@ class HubspotService:
         email = persona.correo
 
         # Buscar si existe el contacto
-        contacto_existente = await self.search_contact_by_email(email)
+        contacto_existente = await self.search_contact_by_email(
+            email, priority=priority
+        )
 
         # Preparar datos de identificación
         id_data = persona.identificacion
@@ -520,7 +826,7 @@ class HubspotService:
 
         # Buscar si existe la beca
         beca_existente = await self.search_beca_by_email(
-            email, datos.carrera_consolidada
+            email, datos.carrera_consolidada, priority=priority
         )
 
         # Si la beca no existe, crearla o actualizarla
@@ -537,6 +843,7 @@ class HubspotService:
                 carrera_consolidada=datos.carrera_consolidada,
                 rut=rut,
                 pasaporte=pasaporte,
+                priority=priority,
             )
         else:
             # Crear nueva beca
@@ -547,6 +854,7 @@ class HubspotService:
                 carrera_consolidada=datos.carrera_consolidada,
                 rut=rut,
                 pasaporte=pasaporte,
+                priority=priority,
             )
 
         # Si el contacto no existe, crearlo o actualizarlo
@@ -561,20 +869,27 @@ class HubspotService:
                 lastname=persona.apellidos,
                 rut=rut,
                 pasaporte=pasaporte,
+                priority=priority,
             )
         else:
+            # Crear el contacto ya asociado a la beca
             resultado_contacto = await self.create_contact(
                 email=email,
                 firstname=persona.nombre,
                 lastname=persona.apellidos,
                 rut=rut,
                 pasaporte=pasaporte,
+                beca_id=resultado_beca["id"],
+                priority=priority,
             )
 
-        # Asociar el contacto con la beca
-        await self.associate_contact_with_beca(
-            contact_id=resultado_contacto["id"], beca_id=resultado_beca["id"]
-        )
+        # Asociar el contacto con la beca si no se hizo al crearlo
+        if has_existing_contact:
+            await self.associate_contact_with_beca(
+                contact_id=resultado_contacto["id"],
+                beca_id=resultado_beca["id"],
+                priority=priority,
+            )
 
         return (
             resultado_contacto,